@@ -0,0 +1,152 @@
+"""
+Measures room event throughput and delivery latency across several worker
+processes sharing the Unix socket bus, next to the in-process bus for a single
+worker.
+
+With --block-ms, the worker hosting the hub repeatedly blocks its event loop
+for that long, the way a synchronous Firestore or Gemini call inside a request
+handler would. Latency is reported only for events sent and received by the
+other workers, so it shows whether blocking in the hub's worker holds up
+everyone else.
+
+Workers the hub drops for falling behind lose events for good, so each worker
+stops publishing and waiting after --deadline seconds. Deliveries missing for
+the events that were published are reported as lost next to the throughput.
+
+Limitations: the workers are bare bus processes publishing in a tight loop.
+No uvicorn, FastAPI or WebSocket clients are involved, so the numbers are an
+upper bound for the bus itself rather than for a real deployment.
+
+Usage: python bench_room_events.py [--workers 4] [--events 5000] [--block-ms 0] [--deadline 60]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from room_events import InProcessRoomEventBus, UnixSocketRoomEventBus
+
+
+def run_worker(socket_path: str, worker_index: int, workers: int, events: int, block_ms: float, deadline: float, ready, results):
+    async def main():
+        bus = UnixSocketRoomEventBus(socket_path)
+        expected = workers * events
+        received = 0
+        latencies = []
+        done = asyncio.Event()
+
+        async def handler(room_id, event):
+            nonlocal received
+            received += 1
+            if not event["from_hub"]:
+                latencies.append(time.time() - event["sent_at"])
+            if received == expected:
+                done.set()
+
+        bus.set_handler(handler)
+        await bus.start()
+        hosts_hub = bus._hub is not None
+        # Block in a thread so the hub keeps relaying while this worker waits for the others.
+        loop = asyncio.get_running_loop()
+        # Start publishing only once every worker is connected to the hub.
+        await loop.run_in_executor(None, ready.wait)
+
+        async def block_loop():
+            # Stands in for synchronous request handlers running on this worker's event loop.
+            while not done.is_set():
+                time.sleep(block_ms / 1000)
+                await asyncio.sleep(0.001)
+
+        blocker = asyncio.create_task(block_loop()) if hosts_hub and block_ms else None
+        published = 0
+
+        async def publish_and_wait():
+            nonlocal published
+            for i in range(events):
+                await bus.publish(f"room_{i % 16}", {"type": "room_updated", "worker": worker_index, "seq": i, "from_hub": hosts_hub, "sent_at": time.time()})
+                published += 1
+                # Yield like a server handling one request at a time would.
+                await asyncio.sleep(0)
+            await done.wait()
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(publish_and_wait(), deadline)
+        except asyncio.TimeoutError:
+            done.set()
+        results.put((time.perf_counter() - started, hosts_hub, latencies, received, published))
+        if blocker:
+            await blocker
+        # Keep the hub alive until every worker has received everything.
+        await loop.run_in_executor(None, ready.wait)
+        await bus.stop()
+
+    asyncio.run(main())
+
+
+def bench_unix_socket(workers: int, events: int, block_ms: float, deadline: float):
+    ctx = multiprocessing.get_context("spawn")
+    socket_path = os.path.join(tempfile.mkdtemp(), "room-events.sock")
+    ready = ctx.Barrier(workers + 1)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=run_worker, args=(socket_path, i, workers, events, block_ms, deadline, ready, results))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    ready.wait()
+    worker_results = [results.get() for _ in processes]
+    ready.wait()
+    for process in processes:
+        process.join()
+    elapsed = max(result[0] for result in worker_results)
+    latencies = sorted(latency for _, hosts_hub, worker_latencies, _, _ in worker_results if not hosts_hub for latency in worker_latencies)
+    delivered = sum(result[3] for result in worker_results)
+    published = sum(result[4] for result in worker_results)
+    return elapsed, latencies, delivered, published
+
+
+def bench_in_process(events: int) -> float:
+    async def main():
+        bus = InProcessRoomEventBus()
+
+        async def handler(room_id, event):
+            pass
+
+        bus.set_handler(handler)
+        await bus.start()
+        started = time.perf_counter()
+        for i in range(events):
+            await bus.publish(f"room_{i % 16}", {"type": "room_updated", "worker": 0, "seq": i})
+        elapsed = time.perf_counter() - started
+        await bus.stop()
+        return elapsed
+
+    return asyncio.run(main())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--events", type=int, default=5000, help="events published by each worker")
+    parser.add_argument("--block-ms", type=float, default=0, help="how long the hub's worker blocks its event loop at a time")
+    parser.add_argument("--deadline", type=float, default=60, help="seconds each worker may spend publishing and receiving")
+    args = parser.parse_args()
+
+    elapsed = bench_in_process(args.events)
+    print(f"in-process, 1 worker: {args.events} deliveries in {elapsed:.3f}s "
+          f"({args.events / elapsed:,.0f} deliveries/s)")
+
+    elapsed, latencies, delivered, published = bench_unix_socket(args.workers, args.events, args.block_ms, args.deadline)
+    expected = args.workers * published
+    print(f"unix socket, {args.workers} workers, hub worker blocking {args.block_ms:g}ms at a time: "
+          f"{published} events published, {delivered} of {expected} deliveries in {elapsed:.3f}s "
+          f"({delivered / elapsed:,.0f} deliveries/s), {expected - delivered} lost")
+    if latencies:
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print(f"latency at workers without the hub: p50 {p50:.1f}ms, p99 {p99:.1f}ms")
@@ -0,0 +1,51 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+FIREBASE_UTILS_NAMES = [
+    "create_poker_room", "add_player_to_room", "update_rebuy", "register_player", "authenticate_player", "settle_game",
+    "update_chip_count", "get_rooms_for_player", "get_room_details", "get_regular_players", "send_game_summary_message",
+]
+
+
+class PydanticOutputParser:
+    def __init__(self, pydantic_object):
+        self.pydantic_object = pydantic_object
+
+    def parse(self, text):
+        return self.pydantic_object.model_validate_json(text)
+
+
+def unavailable(*args, **kwargs):
+    raise RuntimeError("Firestore is not available in tests")
+
+
+@pytest.fixture
+def main(monkeypatch):
+    """
+    Imports main with Firebase and Gemini replaced by stubs so endpoints run
+    without credentials. Tests patch the functions they call on the module.
+    """
+    pytest.importorskip("fastapi")
+    pytest.importorskip("dotenv")
+    stubs = {name: types.ModuleType(name) for name in (
+        "firebase_utils", "firebase_admin", "langchain_google_genai", "langchain_core",
+        "langchain_core.prompts", "langchain_core.output_parsers",
+    )}
+    for name in FIREBASE_UTILS_NAMES:
+        setattr(stubs["firebase_utils"], name, unavailable)
+    stubs["firebase_admin"].firestore = types.ModuleType("firestore")
+    stubs["langchain_google_genai"].GoogleGenerativeAI = unavailable
+    stubs["langchain_core.prompts"].PromptTemplate = object
+    stubs["langchain_core.output_parsers"].PydanticOutputParser = PydanticOutputParser
+    for name, module in stubs.items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+    monkeypatch.setenv("ROOM_EVENT_BUS", "memory")
+    monkeypatch.delenv("IDEMPOTENCY_STORE", raising=False)
+    monkeypatch.delitem(sys.modules, "main", raising=False)
+    yield importlib.import_module("main")
+    sys.modules.pop("main", None)
@@ -108,12 +108,13 @@ def update_room_session_chip_count(room_id: str, user_id: str, new_chip_value: i
         f"players.{user_id}.chip_count": new_chip_value
     })
     
-def update_room_session_rebuy(room_id: str, user_id: str, additional_buy_in: int):
+@firestore.transactional
+def apply_room_session_rebuy(transaction, session_ref, user_id: str, additional_buy_in: int):
     """
-    Processes a rebuy by increasing both the player's total buy_in and chip_count.
+    Reads and updates the player's session entry in one transaction, so concurrent
+    rebuys and chip count updates for the same room are never lost.
     """
-    session_ref = db.collection("room_sessions").document(room_id)
-    session = session_ref.get()
+    session = session_ref.get(transaction=transaction)
     if not session.exists:
         return {"status": "error", "message": "Room session not found"}
     session_data = session.to_dict()
@@ -125,15 +126,19 @@ def update_room_session_rebuy(room_id: str, user_id: str, additional_buy_in: int
     # new_rebuy_total = player_data.get("rebuy_total", 0) + additional_buy_in
     current_rebuys = player_data.get("rebuys", [])
     current_rebuys.append(additional_buy_in)
-    session_ref.update({
-        f"players.{user_id}": {
-            "buy_in": player_data["buy_in"],
-            "chip_count": new_chip_count,
-            "rebuys": current_rebuys
-        }
+    transaction.update(session_ref, {
+        f"players.{user_id}.chip_count": new_chip_count,
+        f"players.{user_id}.rebuys": current_rebuys
     })
     return {"message": f"Player {user_id} rebought chips for {additional_buy_in}", "rebuy_total": current_rebuys}
 
+def update_room_session_rebuy(room_id: str, user_id: str, additional_buy_in: int):
+    """
+    Processes a rebuy by increasing both the player's total buy_in and chip_count.
+    """
+    session_ref = db.collection("room_sessions").document(room_id)
+    return apply_room_session_rebuy(db.transaction(), session_ref, user_id, additional_buy_in)
+
 def get_room_session(room_id: str):
     session_ref = db.collection("room_sessions").document(room_id)
     session = session_ref.get()
@@ -167,9 +172,14 @@ def get_latest_room_id():
     return None
 
 # Add player to a room (create profile if doesn't exist)
-def add_player_to_room(room_id: str, user_id: str, buy_in: int):
-    room_ref = db.collection("games").document(room_id)
-    room_doc = room_ref.get()
+@firestore.transactional
+def apply_add_player(transaction, room_ref, user_id: str, buy_in: int):
+    """
+    Checks and records room membership in one transaction, so two concurrent adds
+    of the same player cannot both pass the membership check.
+    """
+    room_id = room_ref.id
+    room_doc = room_ref.get(transaction=transaction)
     if not room_doc.exists:
         return {"status": "error", "message": "Room not found"}
     
@@ -179,7 +189,7 @@ def add_player_to_room(room_id: str, user_id: str, buy_in: int):
         return {"status": "error", "message": "Player already exists in the room"}
     
     player_ref = db.collection("players").document(user_id)
-    player_doc = player_ref.get()
+    player_doc = player_ref.get(transaction=transaction)
     if not player_doc.exists:
         # return {"status": "error", "message": "Player not registered"}
         default_player_data = {
@@ -190,24 +200,37 @@ def add_player_to_room(room_id: str, user_id: str, buy_in: int):
             "historical_buy_ins": [],
             "chip_count": 0
         }
-        db.collection("players").document(user_id).set(default_player_data)
+        transaction.set(player_ref, default_player_data)
     
     # player_data = player_doc.to_dict()
     # player_name = player_data.get("name", "Unknown")
         
     # Add player to room
-    room_ref.update({
+    transaction.update(room_ref, {
          "players": firestore.ArrayUnion([user_id])
     })
     
     # Update the room session to record the player's buy-in
-    update_room_session_player(room_id, user_id, buy_in)
+    session_ref = db.collection("room_sessions").document(room_id)
+    transaction.set(session_ref, {
+        "players": {
+            user_id: {
+                "buy_in": buy_in,
+                "chip_count": buy_in,
+                "rebuys": []
+            }
+        }
+    }, merge=True)
     
     return {
         "message": f"Player {user_id} added to room {room_id} with buy-in {buy_in}",
         "user_id": user_id
     }
 
+def add_player_to_room(room_id: str, user_id: str, buy_in: int):
+    room_ref = db.collection("games").document(room_id)
+    return apply_add_player(db.transaction(), room_ref, user_id, buy_in)
+
 def update_chip_count(user_id: str, room_id: str, new_chip_value: int):
     update_room_session_chip_count(room_id, user_id, new_chip_value)
     return {"message": f"Player {user_id} chip count updated by {new_chip_value}"}
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import hmac
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from pydantic import BaseModel
+
+from runtime_dir import create_private_file, private_runtime_dir
+
+
+def key_reused_error():
+    return {"status": "error", "message": "Idempotency-Key was already used with a different request"}
+
+
+def status_only(result):
+    """
+    What is remembered for sensitive requests (sign-up and login): the outcome
+    without credentials or contact details.
+    """
+    return {"status": result.get("status", "success")} if isinstance(result, dict) else None
+
+
+async def call(func: Callable[[], Union[Any, Awaitable[Any]]]):
+    result = func()
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class IdempotencyStore:
+    """
+    Remembers the response of each mutating request by its Idempotency-Key so
+    that client retries and hedged requests are only executed once.
+
+    Keys are scoped by route and remembered for ``ttl_seconds``. A request that
+    arrives while the first one with the same key is still running waits for it
+    and receives the same response instead of executing again.
+
+    Entries live in this process only, so this store is for a single worker.
+    Request bodies are fingerprinted with an HMAC under ``secret`` so that stored
+    fingerprints do not reveal the passwords some bodies contain.
+    """
+
+    def __init__(self, ttl_seconds: float = 24 * 60 * 60, max_entries: int = 10000, secret: Optional[bytes] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._secret = secret or os.urandom(32)
+        # key -> (expires_at, fingerprint, future); insertion order is expiry order.
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _purge(self, now: float):
+        while self._entries:
+            expires_at, _, _ = next(iter(self._entries.values()))
+            if expires_at > now and len(self._entries) < self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    async def run(
+        self,
+        idempotency_key: Optional[str],
+        route: str,
+        payload: BaseModel,
+        func: Callable[[], Union[Any, Awaitable[Any]]],
+        sensitive: bool = False,
+    ):
+        """
+        Executes ``func`` once per (route, idempotency_key) and returns its result.
+        Without a key the request is executed as before. For ``sensitive`` requests
+        repeats only get the status of the first response.
+        """
+        if not idempotency_key:
+            return await call(func)
+
+        key = f"{route}:{idempotency_key}"
+        fingerprint = hmac.new(self._secret, payload.model_dump_json().encode(), hashlib.sha256).hexdigest()
+        now = time.monotonic()
+        self._purge(now)
+
+        entry = self._entries.get(key)
+        if entry:
+            _, stored_fingerprint, future = entry
+            if stored_fingerprint != fingerprint:
+                return key_reused_error()
+            # Shield so a cancelled retry does not cancel the original request's result.
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._entries[key] = (now + self.ttl_seconds, fingerprint, future)
+        try:
+            result = await self._execute(key, fingerprint, func, sensitive)
+        except BaseException as e:
+            # Failed requests are not remembered so the client can retry them.
+            if self._entries.get(key, (None, None, None))[2] is future:
+                del self._entries[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Mark the exception as retrieved when nobody else was waiting on it.
+                future.exception()
+            raise
+        future.set_result(result)
+        if sensitive and self._entries.get(key, (None, None, None))[2] is future:
+            remembered = loop.create_future()
+            remembered.set_result(status_only(result))
+            self._entries[key] = (now + self.ttl_seconds, fingerprint, remembered)
+        return result
+
+    async def _execute(self, key: str, fingerprint: str, func: Callable[[], Union[Any, Awaitable[Any]]], sensitive: bool):
+        """
+        Runs the first request for a key in this process.
+        """
+        return await call(func)
+
+
+class SqliteIdempotencyStore(IdempotencyStore):
+    """
+    Shares remembered responses between uvicorn workers through a SQLite file,
+    so a retry that lands on a different worker is not executed again.
+
+    The first worker to insert a key runs the request and stores its response as
+    JSON; other workers poll until it appears. While the request runs its worker
+    refreshes the claim, so a slow request is never run twice; a claim that has
+    not been refreshed for ``pending_timeout_seconds`` belongs to a dead worker
+    and is taken over.
+
+    The database file is created readable by the current user only. Without a
+    ``secret``, one is generated and kept next to it in ``<path>.key`` so every
+    worker fingerprints bodies the same way.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: float = 24 * 60 * 60,
+        max_entries: int = 10000,
+        pending_timeout_seconds: float = 120,
+        poll_interval_seconds: float = 0.05,
+        purge_interval_seconds: float = 60,
+        secret: Optional[bytes] = None,
+    ):
+        super().__init__(ttl_seconds, max_entries, secret or self._load_secret(f"{path}.key"))
+        self.pending_timeout_seconds = pending_timeout_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.purge_interval_seconds = purge_interval_seconds
+        self._last_purge = 0.0
+        create_private_file(path)
+        # Queries run in worker threads, one at a time per store.
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        for journal in (f"{path}-wal", f"{path}-shm"):
+            if os.path.exists(journal):
+                os.chmod(journal, 0o600)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, claimed_at REAL NOT NULL, "
+            "heartbeat_at REAL NOT NULL, expires_at REAL NOT NULL, response TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at)")
+
+    @staticmethod
+    def _load_secret(path: str) -> bytes:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            # Another worker created it; wait until its secret has been written.
+            for _ in range(100):
+                with open(path, "rb") as f:
+                    secret = f.read()
+                if secret:
+                    return secret
+                time.sleep(0.01)
+            raise RuntimeError(f"Idempotency secret file {path} is empty")
+        secret = os.urandom(32)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+
+    def _query(self, sql: str, params: tuple = ()):
+        with self._db_lock:
+            cursor = self._db.execute(sql, params)
+            return cursor.rowcount, cursor.fetchall()
+
+    def _claim(self, key: str, fingerprint: str, now: float):
+        """
+        Tries to claim ``key`` for this request. Returns the claim time on success,
+        otherwise the existing row.
+        """
+        if now - self._last_purge >= self.purge_interval_seconds:
+            self._last_purge = now
+            self._query("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        # An expired key, or a claim whose worker stopped refreshing it, can be taken over.
+        self._query(
+            "DELETE FROM idempotency_keys WHERE key = ? AND (expires_at <= ? OR (response IS NULL AND heartbeat_at <= ?))",
+            (key, now, now - self.pending_timeout_seconds),
+        )
+        inserted, _ = self._query(
+            "INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, claimed_at, heartbeat_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, fingerprint, now, now, now + self.ttl_seconds),
+        )
+        if inserted == 1:
+            return now, None
+        return None, self._read(key)
+
+    def _read(self, key: str):
+        _, rows = self._query(
+            "SELECT fingerprint, response, heartbeat_at, expires_at FROM idempotency_keys WHERE key = ?", (key,)
+        )
+        return rows[0] if rows else None
+
+    def _is_abandoned(self, row, now: float) -> bool:
+        _, response, heartbeat_at, expires_at = row
+        return expires_at <= now or (response is None and heartbeat_at <= now - self.pending_timeout_seconds)
+
+    async def _heartbeat(self, key: str, claimed_at: float):
+        """
+        Refreshes this worker's claim on ``key`` until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.pending_timeout_seconds / 3)
+            await asyncio.to_thread(
+                self._query,
+                "UPDATE idempotency_keys SET heartbeat_at = ? WHERE key = ? AND claimed_at = ? AND response IS NULL",
+                (time.time(), key, claimed_at),
+            )
+
+    async def _execute(self, key: str, fingerprint: str, func: Callable[[], Union[Any, Awaitable[Any]]], sensitive: bool):
+        claimed_at, row = await asyncio.to_thread(self._claim, key, fingerprint, time.time())
+        while claimed_at is None:
+            if row is None or self._is_abandoned(row, time.time()):
+                claimed_at, row = await asyncio.to_thread(self._claim, key, fingerprint, time.time())
+                continue
+            stored_fingerprint, response, _, _ = row
+            if stored_fingerprint != fingerprint:
+                return key_reused_error()
+            if response is not None:
+                return json.loads(response)
+            # Waiting on another worker only reads, so it never holds the write lock.
+            await asyncio.sleep(self.poll_interval_seconds)
+            row = await asyncio.to_thread(self._read, key)
+
+        heartbeat = asyncio.create_task(self._heartbeat(key, claimed_at))
+        try:
+            result = await call(func)
+        except BaseException:
+            heartbeat.cancel()
+            # Release the claim so a retry on any worker runs the request again.
+            await asyncio.to_thread(
+                self._query,
+                "DELETE FROM idempotency_keys WHERE key = ? AND claimed_at = ? AND response IS NULL",
+                (key, claimed_at),
+            )
+            raise
+        heartbeat.cancel()
+        response = json.dumps(result, default=str)
+        await asyncio.to_thread(
+            self._query,
+            "UPDATE idempotency_keys SET response = ? WHERE key = ? AND claimed_at = ?",
+            (json.dumps(status_only(result), default=str) if sensitive else response, key, claimed_at),
+        )
+        # Answer with what a retry will read back, so both get the same response.
+        return json.loads(response)
+
+
+def create_idempotency_store() -> IdempotencyStore:
+    """
+    Builds the store selected by IDEMPOTENCY_STORE: "memory" for a single worker,
+    or "sqlite" to share keys between workers through IDEMPOTENCY_DB (by default
+    in a directory private to this user). IDEMPOTENCY_SECRET, when set, is the
+    fingerprint key shared by all workers. Running several workers
+    (ROOM_EVENT_BUS=unix) defaults to "sqlite" and rejects "memory", since a
+    retry reaching another worker would run again.
+    """
+    ttl_seconds = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+    secret = os.getenv("IDEMPOTENCY_SECRET", "").encode() or None
+    multi_worker = os.getenv("ROOM_EVENT_BUS", "memory") == "unix"
+    kind = os.getenv("IDEMPOTENCY_STORE", "sqlite" if multi_worker else "memory")
+    if kind == "memory":
+        if multi_worker:
+            raise ValueError("IDEMPOTENCY_STORE=memory cannot be used with ROOM_EVENT_BUS=unix; use sqlite")
+        return IdempotencyStore(ttl_seconds=ttl_seconds, secret=secret)
+    if kind == "sqlite":
+        path = os.getenv("IDEMPOTENCY_DB") or os.path.join(private_runtime_dir(), "idempotency.db")
+        return SqliteIdempotencyStore(path, ttl_seconds=ttl_seconds, secret=secret)
+    raise ValueError(f"Unknown IDEMPOTENCY_STORE: {kind}")
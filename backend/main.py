@@ -4,17 +4,22 @@ from firebase_utils import ( create_poker_room, add_player_to_room, update_rebuy
                             get_room_details, get_regular_players, send_game_summary_message)
 import os
 from pathlib import Path
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, WebSocket, WebSocketDisconnect
 from typing import Dict, List
 import json
 import re
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+import asyncio
 from pydantic import BaseModel, Field, ValidationError
 from langchain_google_genai import GoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 from firebase_admin import firestore
 from typing import Optional
+from contextlib import asynccontextmanager
+from idempotency import create_idempotency_store
+from room_events import create_room_event_bus
 
 
 # Load environment variables from .env file
@@ -32,7 +37,17 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("Missing GEMINI_API_KEY environment variable")
 print(f"Gemini API Key loaded: {GEMINI_API_KEY[:5]}...")
-app = FastAPI()
+
+# Carries room updates to every worker; set ROOM_EVENT_BUS=unix when running several uvicorn workers.
+room_event_bus = create_room_event_bus()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await room_event_bus.start()
+    yield
+    await room_event_bus.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -42,9 +57,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dictionary to track active WebSocket connections
+# Dictionary to track active WebSocket connections held by this worker
 active_connections: Dict[str, List[WebSocket]] = {}
 
+# A client that cannot take an event within this time is disconnected so it cannot hold up the room.
+WEBSOCKET_SEND_TIMEOUT_SECONDS = 2
+
+async def send_room_event(room_id: str, websocket: WebSocket, event: dict):
+    try:
+        await asyncio.wait_for(websocket.send_json(event), WEBSOCKET_SEND_TIMEOUT_SECONDS)
+    except Exception:
+        if websocket in active_connections.get(room_id, []):
+            active_connections[room_id].remove(websocket)
+        await websocket.close()
+
+async def deliver_room_event(room_id: str, event: dict):
+    # Send an event from the bus to this worker's clients in the room concurrently, dropping slow or dead sockets.
+    await asyncio.gather(*[send_room_event(room_id, websocket, event) for websocket in list(active_connections.get(room_id, []))], return_exceptions=True)
+
+room_event_bus.set_handler(deliver_room_event)
+
+async def publish_room_event(room_id: Optional[str], action: str, result):
+    # Tell every worker about a successful room mutation, then hand the result back to the caller.
+    if room_id and not (isinstance(result, dict) and result.get("status") == "error"):
+        await room_event_bus.publish(room_id, {"type": "room_updated", "action": action, "room_id": room_id, "result": result})
+    return result
+
+async def run_room_mutation(room_id: str, action: str, func, *args):
+    # Run the blocking Firestore call off the event loop, then publish its result.
+    result = await run_in_threadpool(func, *args)
+    return await publish_room_event(room_id, action, result)
+
+@app.websocket("/ws/{room_id}")
+async def room_websocket(websocket: WebSocket, room_id: str):
+    await websocket.accept()
+    active_connections.setdefault(room_id, []).append(websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if websocket in active_connections.get(room_id, []):
+            active_connections[room_id].remove(websocket)
+        if not active_connections.get(room_id):
+            active_connections.pop(room_id, None)
+
+# Cached responses of mutating requests, keyed by the client's Idempotency-Key header.
+# Shared between workers through SQLite when ROOM_EVENT_BUS=unix.
+idempotency_store = create_idempotency_store()
+
 class RegisterPlayerRequest(BaseModel):
     user_id: str
     player_name: str
@@ -52,16 +114,16 @@ class RegisterPlayerRequest(BaseModel):
     phone: int
 
 @app.post("/register_player/")
-async def register_player_endpoint(payload: RegisterPlayerRequest):
-    return register_player(payload.user_id, payload.player_name, payload.password, payload.phone)
+async def register_player_endpoint(payload: RegisterPlayerRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/register_player/", payload, lambda: run_in_threadpool(register_player, payload.user_id, payload.player_name, payload.password, payload.phone), sensitive=True)
 
 class AuthenticatePlayerRequest(BaseModel):
     user_id: str
     password: str
 
 @app.post("/authenticate_player/")
-async def authenticate_player_endpoint(payload: AuthenticatePlayerRequest):
-    return authenticate_player(payload.user_id, payload.password)
+async def authenticate_player_endpoint(payload: AuthenticatePlayerRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/authenticate_player/", payload, lambda: run_in_threadpool(authenticate_player, payload.user_id, payload.password), sensitive=True)
 
 class CreateRoomRequest(BaseModel):
     buy_in: int
@@ -69,8 +131,8 @@ class CreateRoomRequest(BaseModel):
     rebuys: bool = False
 
 @app.post("/create_room/")
-async def create_room(payload: CreateRoomRequest):
-    return create_poker_room(payload.buy_in, payload.created_by, payload.rebuys)
+async def create_room(payload: CreateRoomRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/create_room/", payload, lambda: run_in_threadpool(create_poker_room, payload.buy_in, payload.created_by, payload.rebuys))
 
 class AddPlayerRequest(BaseModel):
     room_id: str
@@ -78,8 +140,8 @@ class AddPlayerRequest(BaseModel):
     buy_in: int
 
 @app.post("/add_player/")
-async def add_player(payload: AddPlayerRequest):
-    return add_player_to_room(payload.room_id, payload.user_id, payload.buy_in)
+async def add_player(payload: AddPlayerRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/add_player/", payload, lambda: run_room_mutation(payload.room_id, "add_player", add_player_to_room, payload.room_id, payload.user_id, payload.buy_in))
 
 class UpdateRebuyRequest(BaseModel):
     room_id: str
@@ -87,8 +149,8 @@ class UpdateRebuyRequest(BaseModel):
     buy_in: int
 
 @app.post("/update_rebuy/")
-async def update_rebuy_endpoint(payload: UpdateRebuyRequest):
-    return update_rebuy(payload.user_id, payload.room_id, payload.buy_in)
+async def update_rebuy_endpoint(payload: UpdateRebuyRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/update_rebuy/", payload, lambda: run_room_mutation(payload.room_id, "update_rebuy", update_rebuy, payload.user_id, payload.room_id, payload.buy_in))
 
 class UpdateChipCountRequest(BaseModel):
     room_id: str
@@ -96,15 +158,15 @@ class UpdateChipCountRequest(BaseModel):
     chip_change: int
 
 @app.post("/update_chip_count/")
-async def update_chip_count_endpoint(payload: UpdateChipCountRequest):
-    return update_chip_count(payload.user_id, payload.room_id, payload.chip_change)
+async def update_chip_count_endpoint(payload: UpdateChipCountRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/update_chip_count/", payload, lambda: run_room_mutation(payload.room_id, "update_chip_count", update_chip_count, payload.user_id, payload.room_id, payload.chip_change))
 
 class SettleGameRequest(BaseModel):
     room_id: str
 
 @app.post("/settle_game/")
-async def settle_game_endpoint(payload: SettleGameRequest):
-    return settle_game(payload.room_id)
+async def settle_game_endpoint(payload: SettleGameRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/settle_game/", payload, lambda: run_room_mutation(payload.room_id, "settle_game", settle_game, payload.room_id))
 
 @app.get("/get_rooms/{user_id}")
 async def get_rooms(user_id: str):
@@ -137,7 +199,11 @@ class CommandRequest(BaseModel):
     clarification_response: Optional[str] = None
     
 @app.post("/execute_command/")
-async def execute_command(payload: CommandRequest):
+async def execute_command(payload: CommandRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    # The AI call and the resulting mutation run once per key; retries get the first answer.
+    return await idempotency_store.run(idempotency_key, "/execute_command/", payload, lambda: run_command(payload))
+
+async def run_command(payload: CommandRequest):
     command = payload.command
     logged_in_user = payload.user_id
     current_room = payload.room_id
@@ -175,7 +241,7 @@ async def execute_command(payload: CommandRequest):
     ai = GoogleGenerativeAI(api_key=GEMINI_API_KEY, model= "gemini-1.5-pro-001", temperature=0)
     
     # Generate the response with structured output.
-    ai_response = ai.generate([prompt])
+    ai_response = await run_in_threadpool(ai.generate, [prompt])
     print(ai_response)
 
     
@@ -196,7 +262,8 @@ async def execute_command(payload: CommandRequest):
         buy_in = parameters.get("buy_in")
         created_by = logged_in_user
         rebuys = parameters.get("rebuys", False)
-        result = create_poker_room(buy_in, created_by, rebuys)
+        # A new room has no listeners yet, so there is nothing to publish.
+        return await run_in_threadpool(create_poker_room, buy_in, created_by, rebuys)
     elif action == "add_player":
         # For add_player, use the provided current room id.
         room_id_used = current_room
@@ -215,21 +282,22 @@ async def execute_command(payload: CommandRequest):
                     return {"status": "error", "message": "Could not parse clarification answer", "error": str(e)}
             else:
                 return {"status": "error", "message": "Missing parameters for add_player"}
-        result = add_player_to_room(room_id_used, user_id_param, buy_in_value)
+        result = await run_in_threadpool(add_player_to_room, room_id_used, user_id_param, buy_in_value)
     elif action == "update_chips":
         room_id = current_room
         user_id = parameters.get("user_id")
         new_chip_count = parameters.get("new_chip_count")
-        result = update_chip_count(user_id, room_id, new_chip_count)
+        result = await run_in_threadpool(update_chip_count, user_id, room_id, new_chip_count)
+        action = "update_chip_count"
     elif action == "update_rebuy":
         room_id = current_room
         user_id = parameters.get("user_id")
         buy_in = parameters.get("buy_in")
-        result = update_rebuy(user_id, room_id, buy_in)
+        result = await run_in_threadpool(update_rebuy, user_id, room_id, buy_in)
     else:
-        result = {"status": "error", "message": "Unsupported action"}
+        return {"status": "error", "message": "Unsupported action"}
     
-    return result
+    return await publish_room_event(current_room, action, result)
 
 # Define a request model for sending messages.
 class SendMessageRequest(BaseModel):
@@ -238,8 +306,8 @@ class SendMessageRequest(BaseModel):
 
 # Endpoint to send the game summary message.
 @app.post("/send_message/")
-async def send_message_endpoint(payload: SendMessageRequest):
-    return send_game_summary_message(payload.room_id, payload.message)
+async def send_message_endpoint(payload: SendMessageRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    return await idempotency_store.run(idempotency_key, "/send_message/", payload, lambda: run_in_threadpool(send_game_summary_message, payload.room_id, payload.message))
 
 if __name__ == "__main__":
     import uvicorn
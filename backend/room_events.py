@@ -0,0 +1,283 @@
+import asyncio
+from abc import ABC, abstractmethod
+import fcntl
+import json
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from runtime_dir import private_runtime_dir
+
+RoomEventHandler = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+# Room events can carry a full settle table, so allow lines larger than asyncio's 64 KiB default.
+MAX_EVENT_BYTES = 1 << 20
+RECONNECT_DELAY_SECONDS = 0.2
+# Sent by the hub once a worker is registered, so nothing published after connecting is missed.
+HUB_READY = b"ready\n"
+# Lines the hub buffers for one worker before disconnecting it as too slow.
+HUB_QUEUE_SIZE = 10000
+
+
+class RoomEventBus(ABC):
+    """
+    Publishes room events and hands every event to the handler registered by this
+    worker, which delivers it to the WebSocket clients the worker holds.
+    """
+
+    def __init__(self):
+        self._handler: Optional[RoomEventHandler] = None
+
+    def set_handler(self, handler: RoomEventHandler):
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, room_id: str, event: Dict[str, Any]):
+        pass
+
+    async def _dispatch(self, room_id: str, event: Dict[str, Any]):
+        if self._handler is None:
+            return
+        try:
+            await self._handler(room_id, event)
+        except Exception as e:
+            print(f"Room event delivery failed for {room_id}: {e}")
+
+
+class InProcessRoomEventBus(RoomEventBus):
+    """
+    Delivers events only to clients connected to this process. Suitable for a
+    single uvicorn worker.
+    """
+
+    async def publish(self, room_id: str, event: Dict[str, Any]):
+        await self._dispatch(room_id, event)
+
+
+class RelayHub:
+    """
+    Relays every line a worker sends to all connected workers, the sender included.
+
+    The hub runs its own event loop in a background thread, so blocking request
+    handlers in the worker that hosts it do not hold up relaying for everyone
+    else. Each worker gets a bounded send queue; a worker that falls that far
+    behind is disconnected and reconnects rather than stalling the others.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._ready = threading.Event()
+        self._error: Optional[OSError] = None
+        self._thread: Optional[threading.Thread] = None
+        self._queues: Dict[asyncio.StreamWriter, asyncio.Queue] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, timeout: float = 5.0):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), name="room-event-hub", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            # Let the hub shut itself down if it ever gets going, without waiting for it here.
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._stopping.set)
+            raise RuntimeError(f"Room event hub did not start on {self.socket_path}")
+        if self._error:
+            raise RuntimeError(f"Room event hub could not serve on {self.socket_path}: {self._error}")
+
+    def stop(self):
+        if self._loop and self._thread and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join()
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        server = None
+        try:
+            # Only the lock holder starts a hub, so any socket file left behind belongs to a dead hub.
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            server = await asyncio.start_unix_server(self._serve_worker, self.socket_path, limit=MAX_EVENT_BYTES)
+            # Only workers running as this user may connect and publish room events.
+            os.chmod(self.socket_path, 0o600)
+        except OSError as e:
+            if server:
+                server.close()
+                await server.wait_closed()
+            self._error = e
+            self._ready.set()
+            return
+        print(f"Room event bus: serving hub on {self.socket_path}")
+        self._ready.set()
+        await self._stopping.wait()
+        server.close()
+        # Closing the connections ends each relay task with EOF; cancelling them would log errors.
+        for writer in list(self._queues):
+            writer.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await server.wait_closed()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _serve_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._tasks.add(asyncio.current_task())
+        queue: asyncio.Queue = asyncio.Queue(maxsize=HUB_QUEUE_SIZE)
+        queue.put_nowait(HUB_READY)
+        self._queues[writer] = queue
+        sender = asyncio.create_task(self._send(writer, queue))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client, client_queue in list(self._queues.items()):
+                    try:
+                        client_queue.put_nowait(line)
+                    except asyncio.QueueFull:
+                        print("Room event bus: dropping a worker that fell behind; it will reconnect")
+                        self._queues.pop(client, None)
+                        client.close()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self._queues.pop(writer, None)
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            writer.close()
+            self._tasks.discard(asyncio.current_task())
+
+    async def _send(self, writer: asyncio.StreamWriter, queue: asyncio.Queue):
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            writer.close()
+
+
+class UnixSocketRoomEventBus(RoomEventBus):
+    """
+    Shares room events between all workers on a host through a Unix socket.
+
+    One worker holds an exclusive lock on ``<socket_path>.lock`` and runs the
+    :class:`RelayHub` in a background thread. If that worker exits the lock is
+    released and another worker takes over.
+    """
+
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.socket_path = socket_path
+        self._lock_file = None
+        self._hub: Optional[RelayHub] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self, timeout: float = 5.0):
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Room event bus: hub at {self.socket_path} not reachable yet, delivering locally")
+
+    async def stop(self):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._writer:
+            self._writer.close()
+        if self._hub:
+            await asyncio.get_running_loop().run_in_executor(None, self._hub.stop)
+        if self._lock_file:
+            self._lock_file.close()
+
+    async def publish(self, room_id: str, event: Dict[str, Any]):
+        line = json.dumps({"room_id": room_id, "event": event}).encode() + b"\n"
+        writer = self._writer
+        if writer is None:
+            # Without a hub, at least reach the clients of this worker.
+            await self._dispatch(room_id, event)
+            return
+        try:
+            writer.write(line)
+            await writer.drain()
+        except (ConnectionError, OSError):
+            await self._dispatch(room_id, event)
+
+    async def _run(self):
+        while not self._closing:
+            if self._hub is None:
+                await self._try_serve_hub()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_EVENT_BYTES)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+            try:
+                if await reader.readline() != HUB_READY:
+                    raise ConnectionError("hub closed before registering this worker")
+                self._writer = writer
+                self._connected.set()
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    await self._dispatch(message["room_id"], message["event"])
+            except (ConnectionError, OSError, ValueError) as e:
+                print(f"Room event bus connection lost: {e}")
+            finally:
+                self._writer = None
+                self._connected.clear()
+                writer.close()
+            if not self._closing:
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    async def _try_serve_hub(self):
+        """
+        Starts the hub if no other live worker holds the lock. If the hub fails to
+        start, the lock is released so this or another worker tries again later.
+        """
+        try:
+            if self._lock_file is None:
+                self._lock_file = os.fdopen(os.open(f"{self.socket_path}.lock", os.O_CREAT | os.O_WRONLY, 0o600), "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"Room event bus: could not lock {self.socket_path}.lock: {e}")
+            return
+        hub = RelayHub(self.socket_path)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, hub.start)
+        except RuntimeError as e:
+            print(f"Room event bus: {e}; will retry")
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            return
+        self._hub = hub
+
+
+def create_room_event_bus() -> RoomEventBus:
+    """
+    Builds the bus selected by ROOM_EVENT_BUS: "memory" (default) for a single
+    worker, or "unix" to share events between workers through ROOM_EVENT_SOCKET
+    (by default in a directory private to this user).
+    """
+    kind = os.getenv("ROOM_EVENT_BUS", "memory")
+    if kind == "memory":
+        return InProcessRoomEventBus()
+    if kind == "unix":
+        return UnixSocketRoomEventBus(os.getenv("ROOM_EVENT_SOCKET") or os.path.join(private_runtime_dir(), "room-events.sock"))
+    raise ValueError(f"Unknown ROOM_EVENT_BUS: {kind}")
@@ -0,0 +1,27 @@
+import os
+import stat
+import tempfile
+
+
+def private_runtime_dir() -> str:
+    """
+    Returns a directory only the current user can access, for the files workers
+    share on one host (the idempotency database and the room event socket).
+    Uses $XDG_RUNTIME_DIR when set, otherwise the system temp directory.
+    """
+    base = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    path = os.path.join(base, f"pokergenie-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    # Refuse a directory another user created or opened up ahead of us.
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by this user with mode 0700")
+    return path
+
+
+def create_private_file(path: str):
+    """
+    Creates ``path`` if needed and restricts it to the current user.
+    """
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    os.chmod(path, 0o600)
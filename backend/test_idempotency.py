@@ -0,0 +1,332 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+from pydantic import BaseModel
+
+from idempotency import IdempotencyStore, SqliteIdempotencyStore, create_idempotency_store
+
+
+class RebuyPayload(BaseModel):
+    room_id: str
+    user_id: str
+    buy_in: int
+
+
+def make_counter(delay: float = 0.05):
+    calls = []
+
+    async def rebuy():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return {"message": "rebought", "calls": len(calls)}
+
+    return calls, rebuy
+
+
+def test_parallel_duplicates_run_once():
+    store = IdempotencyStore()
+    calls, rebuy = make_counter()
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        return await asyncio.gather(*[store.run("key-1", "/update_rebuy/", payload, rebuy) for _ in range(20)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(result == {"message": "rebought", "calls": 1} for result in results)
+
+
+def test_same_key_on_another_route_runs_separately():
+    store = IdempotencyStore()
+    calls, rebuy = make_counter(delay=0)
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+        await store.run("key-1", "/add_player/", payload, rebuy)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_key_reused_with_different_body_is_rejected():
+    store = IdempotencyStore()
+    calls, rebuy = make_counter(delay=0)
+
+    async def main():
+        await store.run("key-1", "/update_rebuy/", RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100), rebuy)
+        return await store.run("key-1", "/update_rebuy/", RebuyPayload(room_id="room_1", user_id="akshay", buy_in=200), rebuy)
+
+    result = asyncio.run(main())
+    assert result["status"] == "error"
+    assert len(calls) == 1
+
+
+def test_failed_request_is_not_remembered():
+    store = IdempotencyStore()
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("Firestore unavailable")
+        return {"message": "rebought"}
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await store.run("key-1", "/update_rebuy/", payload, flaky)
+        return await store.run("key-1", "/update_rebuy/", payload, flaky)
+
+    assert asyncio.run(main()) == {"message": "rebought"}
+    assert len(attempts) == 2
+
+
+def test_waiters_see_the_failure_of_the_first_request():
+    store = IdempotencyStore()
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise RuntimeError("Firestore unavailable")
+
+    async def main():
+        return await asyncio.gather(
+            *[store.run("key-1", "/update_rebuy/", payload, failing) for _ in range(5)],
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_entries_expire_after_ttl():
+    store = IdempotencyStore(ttl_seconds=0.05)
+    calls, rebuy = make_counter(delay=0)
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+        time.sleep(0.1)
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_oldest_entries_are_evicted_past_max_entries():
+    store = IdempotencyStore(max_entries=2)
+    calls, rebuy = make_counter(delay=0)
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        for key in ("key-1", "key-2", "key-3"):
+            await store.run(key, "/update_rebuy/", payload, rebuy)
+        # key-3 is still remembered, key-1 was evicted to make room for it.
+        await store.run("key-3", "/update_rebuy/", payload, rebuy)
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+
+    asyncio.run(main())
+    assert len(calls) == 4
+
+
+def test_requests_without_key_always_run():
+    store = IdempotencyStore()
+    calls, rebuy = make_counter(delay=0)
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        await store.run(None, "/update_rebuy/", payload, rebuy)
+        await store.run(None, "/update_rebuy/", payload, rebuy)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_sqlite_store_runs_once_across_workers(tmp_path):
+    # Two stores on one database file stand in for two uvicorn workers.
+    path = str(tmp_path / "idempotency.db")
+    workers = [SqliteIdempotencyStore(path), SqliteIdempotencyStore(path)]
+    calls, rebuy = make_counter()
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    async def main():
+        return await asyncio.gather(
+            *[workers[i % 2].run("key-1", "/update_rebuy/", payload, rebuy) for i in range(10)]
+        )
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(result == {"message": "rebought", "calls": 1} for result in results)
+
+
+def test_sqlite_store_rejects_different_body_from_another_worker(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    calls, rebuy = make_counter(delay=0)
+
+    async def main():
+        await SqliteIdempotencyStore(path).run(
+            "key-1", "/update_rebuy/", RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100), rebuy
+        )
+        return await SqliteIdempotencyStore(path).run(
+            "key-1", "/update_rebuy/", RebuyPayload(room_id="room_1", user_id="akshay", buy_in=200), rebuy
+        )
+
+    assert asyncio.run(main())["status"] == "error"
+    assert len(calls) == 1
+
+
+def test_sqlite_store_releases_failed_claims(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("Firestore unavailable")
+        return {"message": "rebought"}
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await SqliteIdempotencyStore(path).run("key-1", "/update_rebuy/", payload, flaky)
+        return await SqliteIdempotencyStore(path).run("key-1", "/update_rebuy/", payload, flaky)
+
+    assert asyncio.run(main()) == {"message": "rebought"}
+    assert len(attempts) == 2
+
+
+def test_sqlite_store_takes_over_claims_of_dead_workers(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    calls, rebuy = make_counter(delay=0)
+
+    async def never_answers():
+        await asyncio.sleep(10)
+
+    async def main():
+        dead_worker = SqliteIdempotencyStore(path)
+        claim = asyncio.create_task(dead_worker.run("key-1", "/update_rebuy/", payload, never_answers))
+        await asyncio.sleep(0.05)
+        result = await SqliteIdempotencyStore(path, pending_timeout_seconds=0.1).run(
+            "key-1", "/update_rebuy/", payload, rebuy
+        )
+        claim.cancel()
+        return result
+
+    assert asyncio.run(main()) == {"message": "rebought", "calls": 1}
+
+
+def test_sqlite_store_does_not_rerun_slow_requests(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    calls, rebuy = make_counter(delay=0.5)
+
+    async def main():
+        first_worker = SqliteIdempotencyStore(path, pending_timeout_seconds=0.1)
+        second_worker = SqliteIdempotencyStore(path, pending_timeout_seconds=0.1)
+        first = asyncio.create_task(first_worker.run("key-1", "/update_rebuy/", payload, rebuy))
+        await asyncio.sleep(0.05)
+        # The first request runs well past the pending timeout but keeps its claim alive.
+        return await asyncio.gather(first, second_worker.run("key-1", "/update_rebuy/", payload, rebuy))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [{"message": "rebought", "calls": 1}] * 2
+
+
+def test_sqlite_store_answers_first_request_like_its_retries(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    def settle():
+        return {"settled_at": datetime(2025, 3, 1, 21, 30)}
+
+    async def main():
+        first = await SqliteIdempotencyStore(path).run("key-1", "/settle_game/", payload, settle)
+        retry = await SqliteIdempotencyStore(path).run("key-1", "/settle_game/", payload, settle)
+        return first, retry
+
+    first, retry = asyncio.run(main())
+    assert first == retry == {"settled_at": "2025-03-01 21:30:00"}
+
+
+def test_multi_worker_mode_needs_a_shared_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("ROOM_EVENT_BUS", "unix")
+    monkeypatch.setenv("IDEMPOTENCY_DB", str(tmp_path / "idempotency.db"))
+    monkeypatch.delenv("IDEMPOTENCY_STORE", raising=False)
+    assert isinstance(create_idempotency_store(), SqliteIdempotencyStore)
+
+    monkeypatch.setenv("IDEMPOTENCY_STORE", "memory")
+    with pytest.raises(ValueError):
+        create_idempotency_store()
+
+
+def test_sqlite_store_keeps_only_the_status_of_sensitive_responses(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+
+    def login():
+        return {"status": "success", "player": {"password": "hashed", "phone": 5550100}}
+
+    async def main():
+        first = await SqliteIdempotencyStore(path).run("key-1", "/authenticate_player/", payload, login, sensitive=True)
+        repeat = await SqliteIdempotencyStore(path).run("key-1", "/authenticate_player/", payload, login, sensitive=True)
+        return first, repeat
+
+    first, repeat = asyncio.run(main())
+    assert first["player"]["phone"] == 5550100
+    assert repeat == {"status": "success"}
+    with open(path, "rb") as f:
+        assert b"5550100" not in f.read()
+
+
+def test_sqlite_store_files_are_private(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    SqliteIdempotencyStore(path)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.stat(f"{path}.key").st_mode & 0o777 == 0o600
+
+
+def test_fingerprints_are_keyed_by_the_secret(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    calls, rebuy = make_counter(delay=0)
+
+    async def main():
+        await SqliteIdempotencyStore(path).run("key-1", "/update_rebuy/", payload, rebuy)
+
+    asyncio.run(main())
+    plain = hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+    with sqlite3.connect(path) as db:
+        (stored,) = db.execute("SELECT fingerprint FROM idempotency_keys").fetchone()
+    assert stored != plain
+
+
+def test_sqlite_store_purges_expired_keys_periodically(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    payload = RebuyPayload(room_id="room_1", user_id="akshay", buy_in=100)
+    calls, rebuy = make_counter(delay=0)
+    store = SqliteIdempotencyStore(path, ttl_seconds=0.05, purge_interval_seconds=0.1)
+
+    def keys():
+        with sqlite3.connect(path) as db:
+            return sorted(row[0] for row in db.execute("SELECT key FROM idempotency_keys"))
+
+    async def main():
+        await store.run("key-1", "/update_rebuy/", payload, rebuy)
+        time.sleep(0.06)
+        # Within the purge interval the expired key-1 row is left alone.
+        await store.run("key-2", "/update_rebuy/", payload, rebuy)
+        assert keys() == ["/update_rebuy/:key-1", "/update_rebuy/:key-2"]
+        time.sleep(0.1)
+        await store.run("key-3", "/update_rebuy/", payload, rebuy)
+        assert keys() == ["/update_rebuy/:key-3"]
+
+    asyncio.run(main())
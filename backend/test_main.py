@@ -0,0 +1,97 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+
+def make_firestore_call(result):
+    calls = []
+    lock = threading.Lock()
+
+    def firestore_call(*args):
+        with lock:
+            calls.append(args)
+        # Slow enough that every duplicate arrives while the first request is running.
+        time.sleep(0.2)
+        return {**result, "calls": len(calls)}
+
+    return calls, firestore_call
+
+
+class FakeGemini:
+    """
+    Answers every prompt with ``text`` and counts the calls.
+    """
+
+    calls = []
+    text = ""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def generate(self, prompts):
+        FakeGemini.calls.append(prompts)
+        return SimpleNamespace(generations=[[SimpleNamespace(text=FakeGemini.text)]])
+
+
+@pytest.fixture
+def client(main):
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+def post_in_parallel(client, path, body, headers, count=10):
+    with ThreadPoolExecutor(count) as pool:
+        responses = list(pool.map(lambda _: client.post(path, json=body, headers=headers), range(count)))
+    assert all(response.status_code == 200 for response in responses)
+    return [response.json() for response in responses]
+
+
+def test_duplicate_rebuys_run_once(main, client, monkeypatch):
+    calls, update_rebuy = make_firestore_call({"message": "rebought"})
+    monkeypatch.setattr(main, "update_rebuy", update_rebuy)
+    body = {"room_id": "room_1", "user_id": "akshay", "buy_in": 100}
+
+    results = post_in_parallel(client, "/update_rebuy/", body, {"Idempotency-Key": "key-1"})
+    assert calls == [("akshay", "room_1", 100)]
+    assert all(result == {"message": "rebought", "calls": 1} for result in results)
+
+
+def test_rebuys_without_a_key_run_every_time(main, client, monkeypatch):
+    calls, update_rebuy = make_firestore_call({"message": "rebought"})
+    monkeypatch.setattr(main, "update_rebuy", update_rebuy)
+    body = {"room_id": "room_1", "user_id": "akshay", "buy_in": 100}
+
+    post_in_parallel(client, "/update_rebuy/", body, {}, count=3)
+    assert len(calls) == 3
+
+
+def test_keys_are_scoped_by_route(main, client, monkeypatch):
+    rebuy_calls, update_rebuy = make_firestore_call({"message": "rebought"})
+    add_calls, add_player_to_room = make_firestore_call({"message": "added"})
+    monkeypatch.setattr(main, "update_rebuy", update_rebuy)
+    monkeypatch.setattr(main, "add_player_to_room", add_player_to_room)
+    body = {"room_id": "room_1", "user_id": "akshay", "buy_in": 100}
+    headers = {"Idempotency-Key": "key-1"}
+
+    assert client.post("/update_rebuy/", json=body, headers=headers).json()["message"] == "rebought"
+    assert client.post("/add_player/", json=body, headers=headers).json()["message"] == "added"
+    assert len(rebuy_calls) == 1 and len(add_calls) == 1
+
+
+def test_duplicate_commands_call_gemini_once(main, client, monkeypatch):
+    calls, update_rebuy = make_firestore_call({"message": "rebought"})
+    monkeypatch.setattr(main, "update_rebuy", update_rebuy)
+    monkeypatch.setattr(main, "GoogleGenerativeAI", FakeGemini)
+    monkeypatch.setattr(FakeGemini, "calls", [])
+    monkeypatch.setattr(FakeGemini, "text", '{"action": "update_rebuy", "parameters": {"user_id": "akshay", "buy_in": 100}}')
+    body = {"command": "akshay rebuys for 100", "user_id": "akshay", "room_id": "room_1"}
+
+    results = post_in_parallel(client, "/execute_command/", body, {"Idempotency-Key": "key-1"})
+    assert len(FakeGemini.calls) == 1
+    assert calls == [("akshay", "room_1", 100)]
+    assert all(result == {"message": "rebought", "calls": 1} for result in results)
@@ -0,0 +1,154 @@
+import asyncio
+import fcntl
+import os
+
+import room_events
+from room_events import HUB_READY, UnixSocketRoomEventBus
+
+
+def make_bus(socket_path: str):
+    received = []
+
+    async def handler(room_id, event):
+        received.append((room_id, event))
+
+    bus = UnixSocketRoomEventBus(socket_path)
+    bus.set_handler(handler)
+    return bus, received
+
+
+async def wait_until(condition, timeout: float = 5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_hub_relays_events_to_every_worker_including_the_sender(tmp_path):
+    # Two buses on one socket stand in for two uvicorn workers.
+    socket_path = str(tmp_path / "room-events.sock")
+    hub_worker, hub_received = make_bus(socket_path)
+    other_worker, other_received = make_bus(socket_path)
+
+    async def main():
+        await hub_worker.start()
+        await other_worker.start()
+        assert hub_worker._hub is not None and other_worker._hub is None
+
+        await other_worker.publish("room_1", {"type": "room_updated", "seq": 1})
+        await hub_worker.publish("room_1", {"type": "room_updated", "seq": 2})
+        await wait_until(lambda: len(hub_received) == 2 and len(other_received) == 2)
+        await other_worker.stop()
+        await hub_worker.stop()
+
+    asyncio.run(main())
+    expected = [("room_1", {"type": "room_updated", "seq": 1}), ("room_1", {"type": "room_updated", "seq": 2})]
+    assert hub_received == expected
+    assert other_received == expected
+
+
+def test_another_worker_takes_over_the_hub_when_its_worker_exits(tmp_path):
+    socket_path = str(tmp_path / "room-events.sock")
+    hub_worker, _ = make_bus(socket_path)
+    other_worker, other_received = make_bus(socket_path)
+    late_worker, late_received = make_bus(socket_path)
+
+    async def main():
+        await hub_worker.start()
+        await other_worker.start()
+        await hub_worker.stop()
+
+        # The lock is released with the exiting worker, so the other worker starts its own hub.
+        await wait_until(lambda: other_worker._hub is not None and other_worker._connected.is_set())
+        await late_worker.start()
+        await late_worker.publish("room_1", {"type": "room_updated"})
+        await wait_until(lambda: len(other_received) == 1 and len(late_received) == 1)
+        await late_worker.stop()
+        await other_worker.stop()
+
+    asyncio.run(main())
+
+
+def test_events_are_delivered_locally_without_a_hub(tmp_path):
+    bus, received = make_bus(str(tmp_path / "room-events.sock"))
+
+    async def main():
+        # Not connected to any hub yet.
+        await bus.publish("room_1", {"type": "room_updated"})
+
+    asyncio.run(main())
+    assert received == [("room_1", {"type": "room_updated"})]
+
+
+def test_hub_that_fails_to_start_releases_the_lock_and_retries(tmp_path):
+    socket_path = str(tmp_path / "room-events.sock")
+    # A directory where the socket should be makes the hub fail to start.
+    os.mkdir(socket_path)
+
+    async def main():
+        bus = UnixSocketRoomEventBus(socket_path)
+        await bus.start(timeout=0.3)
+        assert bus._hub is None
+        # The lock is free again, so no worker is stuck believing it hosts the hub.
+        with open(f"{socket_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        os.rmdir(socket_path)
+        await asyncio.wait_for(bus._connected.wait(), 5)
+        assert bus._hub is not None
+        await bus.stop()
+
+    asyncio.run(main())
+
+
+def test_hub_drops_a_worker_that_stops_reading(tmp_path, monkeypatch):
+    monkeypatch.setattr(room_events, "HUB_QUEUE_SIZE", 4)
+    socket_path = str(tmp_path / "room-events.sock")
+    bus, received = make_bus(socket_path)
+    payload = "x" * 100000
+
+    async def main():
+        await bus.start()
+        # A worker stuck in a blocking call: registered with the hub, but never reads again.
+        stuck_reader, stuck_writer = await asyncio.open_unix_connection(socket_path, limit=room_events.MAX_EVENT_BYTES)
+        assert await stuck_reader.readline() == HUB_READY
+
+        for i in range(50):
+            await bus.publish("room_1", {"seq": i, "payload": payload})
+            await wait_until(lambda: len(received) == i + 1)
+
+        # The hub closed the stuck worker's connection instead of holding up the others.
+        await asyncio.wait_for(stuck_reader.read(), 5)
+        assert stuck_reader.at_eof()
+        stuck_writer.close()
+        await bus.stop()
+
+    asyncio.run(main())
+    assert [event["seq"] for _, event in received] == list(range(50))
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.sent = []
+        self.closed = False
+
+    async def send_json(self, event):
+        await asyncio.sleep(self.delay)
+        self.sent.append(event)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_deliver_room_event_drops_sockets_that_time_out(main, monkeypatch):
+    monkeypatch.setattr(main, "WEBSOCKET_SEND_TIMEOUT_SECONDS", 0.05)
+    slow, fast = FakeWebSocket(delay=10), FakeWebSocket()
+    main.active_connections["room_1"] = [slow, fast]
+
+    asyncio.run(main.deliver_room_event("room_1", {"type": "room_updated"}))
+    assert fast.sent == [{"type": "room_updated"}] and not fast.closed
+    assert slow.closed and slow.sent == []
+    assert main.active_connections["room_1"] == [fast]